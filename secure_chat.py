@@ -5,57 +5,84 @@ Usage:
   Run one peer with --listen and another with --connect, specifying peer IP/port and peer's GPG key ID.
   Example: python3 secure_chat.py --listen --port 9000 --peer-key partner@example.com
            python3 secure_chat.py --connect 192.168.1.5 --port 9000 --peer-key partner@example.com
+  Use --window <bytes> to fix the socket send/receive buffers (e.g. 4194304 for long fat
+  links); by default the kernel's buffer autotuning is left alone.
 
 This tool uses GPG for encryption and decryption of messages, and a TCP socket for transport.
 It supports IPv4 and IPv6. For additional security, use an SSH tunnel or VPN as described in README.
 """
+import argparse
+import asyncio
+import codecs
 import socket
 import subprocess
-import threading
+import struct
 import sys
 import os
+import tempfile
 
-# Placeholder variables that may be set via command-line arguments or environment
-PEER_ADDRESS = None
-LISTEN_MODE = False
-PORT = 9000
-PEER_GPG_ID = None  # GPG identifier (e.g., key ID or email) of the peer's public key
+CHUNK_SIZE = 65536  # minimum receive buffer size
+BATCH_LIMIT = 32  # most queued chat lines encrypted together in one M frame
+MAX_FRAME = 16 << 20  # largest frame payload accepted from the peer
+
+# Wire format: every frame is a 1-byte type tag, a 4-byte big-endian payload
+# length, then the payload (binary OpenPGP data, no ASCII armor; gpg is always
+# run with --no-armor so an "armor" line in the user's gpg.conf cannot re-enable it).
+#   M  encrypted chat lines; the plaintext is one or more 4-byte length-prefixed
+#      UTF-8 lines, so a burst of queued lines costs one gpg run on each side
+#   F  file transfer; payload is the 8-byte big-endian ciphertext length and the
+#      filename. The ciphertext itself follows the frame directly and is read
+#      straight into gpg rather than buffered as a frame payload.
+TAG_MESSAGE = b"M"
+TAG_FILE = b"F"
+# Bound struct methods for the length fields, compiled once instead of per call
+LENGTH = struct.Struct(">I")
+FILE_SIZE = struct.Struct(">Q")
+
+# Common gpg options: never prompt on the terminal the chat is using. The trust
+# database is checked once, when the peer key is resolved at startup; later runs
+# skip that check with --no-auto-check-trustdb but still enforce key validity.
+GPG_BASE = ["gpg", "--batch", "--no-tty"]
+GPG = GPG_BASE + ["--no-auto-check-trustdb"]
+
+def positive_int(value):
+    """
+    argparse type for sizes that must be a positive integer.
+    """
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    return n
 
 # Parse command-line arguments
-args = sys.argv[1:]
-i = 0
-while i < len(args):
-    if args[i] in ("--listen", "-l"):
-        LISTEN_MODE = True
-    elif args[i] in ("--connect", "-c"):
-        if i + 1 < len(args):
-            PEER_ADDRESS = args[i+1]
-            i += 1
-        else:
-            print("Error: --connect requires an address")
-            sys.exit(1)
-    elif args[i] in ("--port", "-p"):
-        if i + 1 < len(args):
-            PORT = int(args[i+1])
-            i += 1
-        else:
-            print("Error: --port requires a port number")
-            sys.exit(1)
-    elif args[i] in ("--peer-key", "-r"):
-        if i + 1 < len(args):
-            PEER_GPG_ID = args[i+1]
-            i += 1
-        else:
-            print("Error: --peer-key requires a key identifier")
-            sys.exit(1)
-    else:
-        print(f"Unknown argument: {args[i]}")
-        sys.exit(1)
-    i += 1
+parser = argparse.ArgumentParser(
+    description="Encrypted chat and file transfer between two peers.",
+    usage="%(prog)s --listen [--port X] --peer-key <id>\n"
+          "   or: %(prog)s --connect <address> [--port X] --peer-key <id>"
+)
+parser.add_argument("--listen", "-l", action="store_true",
+                    help="wait for the peer to connect")
+parser.add_argument("--connect", "-c", metavar="ADDRESS",
+                    help="connect to the peer at ADDRESS (IPv4 or IPv6)")
+parser.add_argument("--port", "-p", type=int, default=9000,
+                    help="TCP port to listen on or connect to (default: 9000)")
+parser.add_argument("--peer-key", "-r", metavar="ID",
+                    help="GPG key ID or email of the peer (default: $PEER_GPG_ID)")
+parser.add_argument("--window", "-w", type=positive_int, metavar="BYTES",
+                    help="fix SO_SNDBUF/SO_RCVBUF to BYTES instead of kernel autotuning")
+ns = parser.parse_args()
+
+PEER_ADDRESS = ns.connect
+LISTEN_MODE = ns.listen
+PORT = ns.port
+PEER_GPG_ID = ns.peer_key  # GPG identifier (e.g., key ID or email) of the peer's public key
+WINDOW = ns.window  # SO_SNDBUF/SO_RCVBUF size in bytes; None keeps kernel autotuning
 
 if not LISTEN_MODE and PEER_ADDRESS is None:
-    print("Usage: secure_chat.py --listen [--port X] --peer-key <id>\n"
-          "   or: secure_chat.py --connect <address> [--port X] --peer-key <id>\n")
+    parser.print_usage()
     sys.exit(0)
 
 # If peer GPG key identifier is not provided via arguments, check environment variable
@@ -65,43 +92,182 @@ if PEER_GPG_ID is None:
     print("Error: Peer GPG key identifier not specified. Use --peer-key or set PEER_GPG_ID.")
     sys.exit(1)
 
-# Define helper functions for encryption and decryption using GPG
-def encrypt_message(plain_text):
+def resolve_encryption_key(key_id):
     """
-    Encrypt a plaintext string using GPG with the recipient's public key.
-    Returns the ASCII-armored encrypted text as bytes, or None on failure.
+    Look up key_id in the keyring once and return the fingerprint of its newest
+    usable encryption (sub)key with a trailing "!", so gpg takes that exact key
+    instead of searching the keyring and selecting a subkey on every call.
+    Only fully or ultimately valid keys are considered, so an uncertified key that
+    merely carries the peer's email address is never picked.
+    Returns None if no usable key is found.
     """
     try:
         proc = subprocess.run(
-            ["gpg", "--encrypt", "--armor", "-r", PEER_GPG_ID],
-            input=plain_text.encode('utf-8'),
+            GPG_BASE + ["--with-colons", "--list-keys", key_id],
             capture_output=True, check=True
         )
-        return proc.stdout  # encrypted text in ASCII-armored format
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    best = None  # (creation time, fingerprint)
+    created = None  # creation time of the usable key whose fpr line comes next
+    primary_ok = False
+    for line in proc.stdout.decode('utf-8', errors='replace').splitlines():
+        fields = line.split(":")
+        if fields[0] in ("pub", "sub"):
+            valid = fields[1] in ("f", "u")
+            if fields[0] == "pub":
+                primary_ok = valid
+            usable = primary_ok and valid and "e" in fields[11]
+            created = int(fields[5] or 0) if usable else None
+        elif fields[0] == "fpr" and created is not None:
+            if best is None or created >= best[0]:
+                best = (created, fields[9])
+            created = None
+    return best[1] + "!" if best else None
+
+class WarmGPG:
+    """
+    Keeps one gpg process pre-spawned and blocked on stdin, so the fork/exec and
+    keyring load for the next call happen while the previous one is being used.
+    Each call hands its input to the standby process and immediately spawns a
+    replacement. Must be used from the running event loop.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.standby = None  # task resolving to the next gpg process
+
+    def _spawn(self):
+        return asyncio.ensure_future(asyncio.create_subprocess_exec(
+            *self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        ))
+
+    def start(self):
+        """
+        Spawn the first standby process ahead of the first call.
+        """
+        self.standby = self._spawn()
+
+    async def run(self, data):
+        """
+        Feed data to the standby gpg process and return its stdout.
+        Raises subprocess.CalledProcessError if gpg exits non-zero.
+        """
+        # No await between taking the standby and replacing it, so concurrent
+        # callers on the event loop never share a process
+        standby = self.standby or self._spawn()
+        self.standby = self._spawn()
+        proc = await standby
+        if proc.returncode is not None:
+            # The standby died while waiting (e.g. gpg-agent restarted); use a fresh one
+            proc = await self._spawn()
+        out, err = await proc.communicate(data)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, self.args, out, err)
+        return out
+
+    async def close(self):
+        if self.standby is None:
+            return
+        try:
+            proc = await self.standby
+        except OSError:
+            return
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+
+PEER_FPR = resolve_encryption_key(PEER_GPG_ID)
+if PEER_FPR is None:
+    print(f"Error: No valid encryption key found for {PEER_GPG_ID}. Import the peer's public key, "
+          "check its fingerprint with them and certify it (gpg --lsign-key <id>).")
+    sys.exit(1)
+
+# gpg cannot process more than one message per invocation, so instead of a
+# persistent pipe we keep a warm process ready for each direction.
+gpg_encrypt = WarmGPG(GPG + ["--encrypt", "--no-armor", "-r", PEER_FPR])
+gpg_decrypt = WarmGPG(GPG + ["--decrypt"])
+
+# Define helper functions for encryption and decryption using GPG
+async def encrypt_message(lines):
+    """
+    Encrypt one or more plaintext lines as a single GPG message for the recipient's public key.
+    Returns the binary OpenPGP message as bytes, or None on failure.
+    """
+    pack_len = LENGTH.pack
+    parts = []
+    for line in lines:
+        data = line.encode('utf-8')
+        parts += (pack_len(len(data)), data)
+    packed = b"".join(parts)
+    try:
+        return await gpg_encrypt.run(packed)
     except subprocess.CalledProcessError as e:
         # GPG failed (e.g., missing public key)
         sys.stderr.write("Encryption error: " + e.stderr.decode('utf-8') + "\n")
         return None
 
-def decrypt_message(cipher_text_bytes):
+async def decrypt_message(cipher_text_bytes):
     """
-    Decrypt an ASCII-armored ciphertext using GPG.
-    Returns the plaintext as a string, or None if decryption fails.
+    Decrypt a binary OpenPGP ciphertext using GPG.
+    Returns the list of plaintext lines it carries, or None if decryption fails.
     """
     try:
-        proc = subprocess.run(
-            ["gpg", "--decrypt"],
-            input=cipher_text_bytes,
-            capture_output=True, check=True
-        )
-        return proc.stdout.decode('utf-8', errors='ignore')
+        packed = await gpg_decrypt.run(cipher_text_bytes)
     except subprocess.CalledProcessError as e:
         sys.stderr.write("Decryption error: " + e.stderr.decode('utf-8') + "\n")
         return None
+    unpack_len = LENGTH.unpack_from
+    lines = []
+    pos = 0
+    while pos + 4 <= len(packed):
+        (length,) = unpack_len(packed, pos)
+        lines.append(packed[pos + 4:pos + 4 + length].decode('utf-8', errors='ignore'))
+        pos += 4 + length
+    if pos != len(packed):
+        sys.stderr.write("Decryption error: malformed message payload\n")
+        return None
+    return lines
+
+def configure_socket(s):
+    """
+    Apply the socket options selected on the command line.
+    Buffer sizes are only set with --window: setting them explicitly turns off
+    Linux's receive/send buffer autotuning for that socket.
+    """
+    if WINDOW:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, WINDOW)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, WINDOW)
+    # Chat lines are small and interactive: don't let Nagle hold them back
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Detect a vanished peer in ~1 minute instead of TCP's default 2 hours
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    set_quickack(s)
+
+def set_quickack(s):
+    """
+    Ask Linux to ACK incoming data immediately instead of delaying the ACK.
+    The kernel clears TCP_QUICKACK on its own, so call this after every receive.
+    """
+    if hasattr(socket, "TCP_QUICKACK"):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+def set_cork(s, on):
+    """
+    Toggle TCP_CORK (Linux only) so bulk transfers go out in full segments;
+    uncorking flushes the final partial segment immediately.
+    """
+    if hasattr(socket, "TCP_CORK"):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
 
 # Set up socket (IPv6 if address contains ':', else IPv4)
 family = socket.AF_INET6 if (PEER_ADDRESS and ":" in PEER_ADDRESS) else socket.AF_INET
 sock = socket.socket(family, socket.SOCK_STREAM)
+# Set before listen()/connect() so the TCP window scale is negotiated for it
+configure_socket(sock)
 
 if LISTEN_MODE:
     # Bind and listen for incoming connection
@@ -110,6 +276,7 @@ if LISTEN_MODE:
     sock.listen(1)
     print(f"Listening for incoming peer connection on port {PORT}...")
     conn, addr = sock.accept()
+    configure_socket(conn)
     print(f"Peer connected from {addr}")
     connection = conn
 else:
@@ -120,120 +287,404 @@ else:
     print("Connected to peer.")
     connection = sock
 
-# Thread function to receive and decrypt incoming messages
-def receive_thread_func():
+async def wait_fd(fd, write=False):
+    """
+    Wait on the event loop until fd is readable (or writable if write is set).
+    """
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    add, remove = (loop.add_writer, loop.remove_writer) if write else (loop.add_reader, loop.remove_reader)
+    try:
+        add(fd, lambda: ready.done() or ready.set_result(None))
+    except PermissionError:
+        return  # regular files (e.g. stdin redirected from a file) are always ready
+    try:
+        await ready
+    finally:
+        remove(fd)
+
+async def write_all(fd, data):
+    """
+    Write all of data to the non-blocking descriptor fd, waiting whenever it is full.
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            n = os.write(fd, view)
+        except BlockingIOError:
+            await wait_fd(fd, write=True)
+            continue
+        view = view[n:]
+
+async def send_frame(tag, payload):
+    """
+    Send one length-prefixed frame to the peer.
+    """
+    await asyncio.get_running_loop().sock_sendall(connection, b"".join((tag, LENGTH.pack(len(payload)), payload)))
+
+class FrameReader:
+    """
+    Reads frames from the peer on the event loop. Data is received with
+    loop.sock_recv_into() into one reusable buffer sized to SO_RCVBUF, which
+    only waits for readability when the socket is empty.
+    """
+    def __init__(self, s):
+        self.sock = s
+        size = max(CHUNK_SIZE, s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+        self.view = memoryview(bytearray(size))
+        self.pending = bytearray()  # received bytes not yet consumed
+
+    async def _recv(self, limit):
+        """
+        Receive up to limit bytes into the reusable buffer.
+        Returns the byte count, or 0 at EOF.
+        """
+        loop = asyncio.get_running_loop()
+        n = await loop.sock_recv_into(self.sock, self.view[:min(limit, len(self.view))])
+        if n:
+            set_quickack(self.sock)
+        return n
+
+    async def frames(self):
+        """
+        Yield (tag, payload) frames until the connection is closed.
+        A payload is only copied out once its frame is complete.
+        Raises ValueError if the peer announces a payload larger than MAX_FRAME.
+        """
+        pending = self.pending
+        while True:
+            if len(pending) >= 5:
+                (length,) = LENGTH.unpack_from(pending, 1)
+                if length > MAX_FRAME:
+                    raise ValueError(f"frame of {length} bytes exceeds the {MAX_FRAME} byte limit")
+                if len(pending) >= 5 + length:
+                    tag, payload = bytes(pending[:1]), bytes(pending[5:5 + length])
+                    del pending[:5 + length]
+                    yield tag, payload
+                    continue
+            n = await self._recv(len(self.view))
+            if n == 0:
+                return
+            pending += self.view[:n]
+
+    async def read_body(self, size, fd):
+        """
+        Copy the next size bytes from the peer into the non-blocking pipe fd.
+        Where os.splice() is available (Linux) the bytes move from the socket to
+        the pipe inside the kernel; otherwise each receive fills at most one
+        buffer. If the pipe's reader goes away the rest is still consumed so the
+        stream stays in sync.
+        Returns False if the connection closed before size bytes arrived.
+        """
+        async def write(data):
+            nonlocal fd
+            if fd is not None:
+                try:
+                    await write_all(fd, data)
+                except BrokenPipeError:
+                    fd = None
+
+        head = min(size, len(self.pending))
+        if head:
+            await write(self.pending[:head])
+            del self.pending[:head]
+        remaining = size - head
+        if remaining and fd is not None and hasattr(os, "splice"):
+            try:
+                sock_fd = self.sock.fileno()
+                while remaining:
+                    # Only splice once data is waiting; if it still would block
+                    # the socket is readable, so it is the pipe that is full
+                    await wait_fd(sock_fd)
+                    try:
+                        n = os.splice(sock_fd, fd, remaining, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                    except BlockingIOError:
+                        await wait_fd(fd, write=True)
+                        continue
+                    if n == 0:
+                        return False
+                    set_quickack(self.sock)
+                    remaining -= n
+            except BrokenPipeError:
+                fd = None
+            except OSError:
+                pass  # splice() not supported for this pair; copy the rest through the buffer
+        while remaining:
+            n = await self._recv(remaining)
+            if n == 0:
+                return False
+            await write(self.view[:n])
+            remaining -= n
+        return True
+
+def unused_filename(filename):
+    """
+    Return filename, or "name (1).ext", "name (2).ext", ... if it already exists.
+    gpg in batch mode refuses to overwrite its -o target.
+    """
+    stem, ext = os.path.splitext(filename)
+    candidate, n = filename, 0
+    while os.path.lexists(candidate):
+        n += 1
+        candidate = f"{stem} ({n}){ext}"
+    return candidate
+
+async def receive_file(reader, payload):
+    """
+    Decrypt the file whose ciphertext follows an F frame into the announced filename.
+    Returns False if the connection closed partway through.
+    """
+    (size,) = FILE_SIZE.unpack_from(payload)
+    # Never let the peer choose a directory: keep only the last path component.
+    # Names gpg or the terminal would misread (e.g. "-" means stdout to gpg, NUL
+    # cannot be passed as an argument) fall back to a fixed name.
+    filename = os.path.basename(payload[FILE_SIZE.size:].decode('utf-8', errors='replace'))
+    if filename in ("", ".", "..", "-") or any(ord(c) < 32 or ord(c) == 127 for c in filename):
+        filename = "received_file"
+    # Decrypt under a hidden temporary name and only move it into place once gpg
+    # has verified the whole file, so an interrupted transfer leaves nothing behind
+    partial = unused_filename(f".{filename}.part")
+    saved = False
+    try:
+        # gpg reads from a pipe we own, so the ciphertext can be spliced into it
+        r, w = os.pipe()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *GPG, "--decrypt", "-o", os.path.join(".", partial),
+                stdin=r, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+        except BaseException:
+            os.close(w)
+            raise
+        finally:
+            os.close(r)
+        os.set_blocking(w, False)
+        try:
+            complete = await reader.read_body(size, w)
+        except BaseException:
+            proc.kill()
+            await proc.wait()
+            raise
+        finally:
+            os.close(w)
+        if not complete:
+            proc.kill()
+            await proc.wait()
+            return False
+        _, err = await proc.communicate()
+        if proc.returncode == 0:
+            filename = unused_filename(filename)
+            os.replace(partial, filename)
+            saved = True
+            print(f"\n[File received and saved as {filename}]")
+        else:
+            sys.stderr.write("File decryption error: " + err.decode('utf-8') + "\n")
+        return True
+    finally:
+        if not saved:
+            try:
+                os.unlink(partial)
+            except FileNotFoundError:
+                pass
+
+# Task to receive and decrypt incoming messages
+async def receive_loop():
+    reader = FrameReader(connection)
+    frames = reader.frames()
     while True:
         try:
-            data = connection.recv(4096)
-        except Exception as e:
-            sys.stderr.write(f"Socket receive error: {e}\n")
-            break
-        if not data:
+            tag, payload = await anext(frames)
+        except StopAsyncIteration:
             # Connection closed by peer
             print("\n[Connection closed by peer]")
             break
-        # Attempt to interpret incoming data
-        text = None
-        try:
-            text = data.decode('utf-8')
-        except UnicodeDecodeError:
-            text = None
-        if text and text.startswith("FILE:"):
-            # Handle incoming file transfer
-            # Expected format: "FILE:<filename>:\n<ASCII armored data>..."
-            header, sep, armored = text.partition("\n")
-            filename = "received_file"
-            header_parts = header.split(":", 2)
-            if len(header_parts) >= 2:
-                filename = header_parts[1]
-            # If the armored data did not come in one chunk, we may need to receive more.
-            if armored == "" and sep == "\n":
-                # Continue receiving until EOF of PGP message (not fully implemented for brevity)
-                more_data = connection.recv(65536)
-                armored = more_data.decode('utf-8') if more_data else ""
-            cipher_bytes = data[len(header)+1:]  # bytes after the header and newline
-            try:
-                # Decrypt file content and save to filename
-                proc = subprocess.run(
-                    ["gpg", "--decrypt", "-o", filename],
-                    input=cipher_bytes, capture_output=True, check=True
-                )
-                print(f"\n[File received and saved as {filename}]")
-            except subprocess.CalledProcessError as e:
-                sys.stderr.write("File decryption error: " + e.stderr.decode('utf-8') + "\n")
-        else:
+        except OSError as e:
+            sys.stderr.write(f"Socket receive error: {e}\n")
+            break
+        except ValueError as e:
+            sys.stderr.write(f"Unexpected frame from peer: {e}\n")
+            break
+        if tag == TAG_MESSAGE:
             # Handle incoming text message
-            plain = decrypt_message(data)
-            if plain is not None:
-                print(f"\nPeer: {plain}")
+            lines = await decrypt_message(payload)
+            if lines is not None:
+                for line in lines:
+                    print(f"\nPeer: {line}")
             else:
                 print("[Could not decrypt incoming message]")
+        elif tag == TAG_FILE:
+            # Handle incoming file transfer
+            if len(payload) < FILE_SIZE.size:
+                sys.stderr.write("Unexpected frame from peer: truncated file header\n")
+                break
+            try:
+                complete = await receive_file(reader, payload)
+            except OSError as e:
+                sys.stderr.write(f"Socket receive error: {e}\n")
+                break
+            if not complete:
+                print("\n[Connection closed by peer]")
+                break
+        else:
+            sys.stderr.write(f"Unexpected frame type {tag!r} from peer\n")
+            break
+
+async def send_file(filepath):
+    """
+    Encrypt a file with GPG into a temporary file and send it to the peer as an F frame
+    followed by the ciphertext.
+    The ciphertext goes out with loop.sock_sendfile(), so on Linux it is copied from the
+    page cache to the socket without passing through Python.
+    Returns False if the connection failed, True otherwise.
+    """
     try:
-        connection.close()
-    except:
-        pass
-    os._exit(0)  # terminate the program when connection is lost
+        f = open(filepath, "rb")
+    except Exception as e:
+        print(f"Failed to read file: {e}")
+        return True
+    with f, tempfile.TemporaryFile() as tmp:
+        # gpg reads the file and writes the spool file directly, no copies through Python
+        proc = await asyncio.create_subprocess_exec(
+            *GPG, "--encrypt", "--no-armor", "-r", PEER_FPR,
+            stdin=f, stdout=tmp, stderr=subprocess.PIPE
+        )
+        _, err = await proc.communicate()
+        if proc.returncode != 0:
+            sys.stderr.write("Encryption error (file): " + err.decode('utf-8') + "\n")
+            return True
+        size = os.fstat(tmp.fileno()).st_size
+        header = FILE_SIZE.pack(size) + os.path.basename(filepath).encode('utf-8')
+        try:
+            set_cork(connection, True)
+            await send_frame(TAG_FILE, header)
+            await asyncio.get_running_loop().sock_sendfile(connection, tmp, 0, size)
+            set_cork(connection, False)
+        except Exception as e:
+            print(f"File send failed: {e}")
+            return False
+        print(f"[Sent file: {filepath}]")
+        return True
 
-# Start receiver thread
-recv_thread = threading.Thread(target=receive_thread_func, daemon=True)
-recv_thread.start()
+async def send_message(lines):
+    """
+    Encrypt a batch of chat lines with GPG and send them to the peer as one M frame.
+    Returns False if the connection failed, True otherwise.
+    """
+    cipher_bytes = await encrypt_message(lines)
+    if cipher_bytes is None:
+        print("Failed to encrypt message. Not sent.")
+        return True
+    try:
+        await send_frame(TAG_MESSAGE, cipher_bytes)
+    except Exception as e:
+        print(f"Message send failed: {e}")
+        return False
+    return True
 
-# Main loop for sending user messages
-try:
+# Task to encrypt and send queued messages and files, so typing never waits
+# on gpg or the network. Items are ("message", text) or ("file", path); None
+# tells it to stop once everything before it is sent.
+async def sender_loop(outbox):
+    held = []  # item taken off the queue while batching, to be handled next
     while True:
-        user_input = input()
-        if not user_input:
-            continue
-        if user_input.strip().lower() == "/quit":
-            print("Closing connection...")
+        item = held.pop() if held else await outbox.get()
+        if item is None:
             break
-        if user_input.startswith("/send"):
-            # User wants to send a file
-            parts = user_input.split(maxsplit=1)
-            if len(parts) < 2:
-                print("Usage: /send <filepath>")
-                continue
-            filepath = parts[1]
-            if not os.path.isfile(filepath):
-                print(f"File not found: {filepath}")
-                continue
-            try:
-                with open(filepath, "rb") as f:
-                    file_data = f.read()
-            except Exception as e:
-                print(f"Failed to read file: {e}")
-                continue
-            try:
-                proc = subprocess.run(
-                    ["gpg", "--encrypt", "--armor", "-r", PEER_GPG_ID],
-                    input=file_data, capture_output=True, check=True
-                )
-                encrypted_data = proc.stdout
-            except subprocess.CalledProcessError as e:
-                sys.stderr.write("Encryption error (file): " + e.stderr.decode('utf-8') + "\n")
-                continue
-            header = f"FILE:{os.path.basename(filepath)}:\n".encode('utf-8')
-            try:
-                connection.sendall(header + encrypted_data)
-                print(f"[Sent file: {filepath}]")
-            except Exception as e:
-                print(f"File send failed: {e}")
-                break
+        kind, value = item
+        if kind == "file":
+            ok = await send_file(value)
         else:
-            # Send a normal text message
-            cipher_bytes = encrypt_message(user_input)
-            if cipher_bytes is None:
-                print("Failed to encrypt message. Not sent.")
-            else:
+            # Batch any chat lines already waiting behind this one
+            lines = [value]
+            while len(lines) < BATCH_LIMIT:
                 try:
-                    connection.sendall(cipher_bytes)
-                except Exception as e:
-                    print(f"Message send failed: {e}")
+                    item = outbox.get_nowait()
+                except asyncio.QueueEmpty:
                     break
-except (EOFError, KeyboardInterrupt):
-    print("\nExiting chat...")
-finally:
+                if item is None or item[0] != "message":
+                    held.append(item)
+                    break
+                lines.append(item[1])
+            ok = await send_message(lines)
+        if not ok:
+            # Wake the receive task, which then ends the session
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            break
+
+# Task reading lines typed by the user; returns on /quit, raises EOFError at end of input
+async def input_loop(outbox):
+    fd = sys.stdin.fileno()
+    decoder = codecs.getincrementaldecoder(sys.stdin.encoding or 'utf-8')(errors='replace')
+    pending = ""
+    while True:
+        await wait_fd(fd)
+        data = os.read(fd, 4096)
+        if data:
+            pending += decoder.decode(data)
+            *lines, pending = pending.split("\n")
+        else:
+            lines, pending = [pending] if pending else [], ""
+        for user_input in lines:
+            user_input = user_input.rstrip("\r")
+            if not user_input:
+                continue
+            if user_input.strip().lower() == "/quit":
+                print("Closing connection...")
+                return
+            if user_input.startswith("/send"):
+                # User wants to send a file
+                parts = user_input.split(maxsplit=1)
+                if len(parts) < 2:
+                    print("Usage: /send <filepath>")
+                    continue
+                filepath = parts[1]
+                if not os.path.isfile(filepath):
+                    print(f"File not found: {filepath}")
+                    continue
+                outbox.put_nowait(("file", filepath))
+            else:
+                # Send a normal text message
+                outbox.put_nowait(("message", user_input))
+        if not data:
+            raise EOFError
+
+async def main():
+    # Everything runs on one event loop thread: socket, stdin and gpg pipes
+    connection.setblocking(False)
+    gpg_encrypt.start()
+    gpg_decrypt.start()
+    outbox = asyncio.Queue()
+    sender = asyncio.create_task(sender_loop(outbox))
+    receiver = asyncio.create_task(receive_loop())
+    typing = asyncio.create_task(input_loop(outbox))
     try:
-        connection.close()
-    except:
-        pass
+        done, _ = await asyncio.wait({sender, receiver, typing}, return_when=asyncio.FIRST_COMPLETED)
+        if sender in done and sender.exception() is not None:
+            raise sender.exception()
+        if receiver in done and receiver.exception() is not None:
+            raise receiver.exception()
+        if typing in done and typing.exception() is not None:
+            if not isinstance(typing.exception(), EOFError):
+                raise typing.exception()
+            print("\nExiting chat...")
+    finally:
+        typing.cancel()
+        receiver.cancel()
+        # Let the sender task flush whatever is still queued
+        outbox.put_nowait(None)
+        if not sender.done():
+            await sender
+        try:
+            connection.close()
+        except:
+            pass
+        await gpg_encrypt.close()
+        await gpg_decrypt.close()
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    print("\nExiting chat...")